@@ -7,104 +7,298 @@ To run the server:
 Author: Noam Shushan
 """
 
-import datetime
+import contextlib
+import email.utils
+import errno
+import logging
+import logging.handlers
 import os
+import queue
 import socket
 import re
+import select
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 
 # Constants:
 IP = '0.0.0.0'
 PORT = 80
+LOG_LEVEL = logging.INFO  # logging.DEBUG to log every connection and request
 SOCKET_TIMEOUT = 0.1
+# seconds after which a busy keep-alive connection is closed, between requests only (nothing pending from the client).
+# idle connections are closed sooner, after SOCKET_TIMEOUT without a request
+KEEP_ALIVE_MAX_TIME = 5
+ACCEPT_TIMEOUT = 0.5
+LISTEN_BACKLOG = socket.SOMAXCONN
+TCP_CORK = getattr(socket, 'TCP_CORK', getattr(socket, 'TCP_NOPUSH', None))  # TCP_CORK on Linux, TCP_NOPUSH on BSD
+SERVER_PROCESSES = os.cpu_count() or 1  # number of processes accepting clients on the port
+MAX_CLIENTS = (os.cpu_count() or 1) * 4  # number of clients served at the same time, by all the processes together
+# worker threads in each forked server process, so all of them together serve MAX_CLIENTS
+MAX_CLIENTS_PER_PROCESS = max(1, MAX_CLIENTS // SERVER_PROCESSES)
 CLOSE_SERVER_STATUS_CODE = 1
-DEFAULT_URL = 'webroot/index.html'
+REQUEST_BUFFER_SIZE = 4096
+MAX_REQUEST_SIZE = 64 * 1024  # longer requests are rejected
+DEFAULT_URL = b'webroot/index.html'
+WEBROOT = 'webroot'
+STATIC_CACHE_MAX_FILE_SIZE = 1024 * 1024  # bigger files are not kept in memory
+REGISTERED_MAX = 256  # big webroot files kept open for the whole run, far below the open files limit
+LARGE_BODY_SIZE = 4096  # cached bodies from this size are not joined with their header
+FILE_CHUNK_SIZE = 64 * 1024  # read size when a file is sent without sendfile
 REDIRECTION_DICTIONARY = {
-    "webroot/home.html": "webroot/index.html",
-    "home": "webroot/index.html",
-    "home.html": "webroot/index.html",
-    "webroot/home": "webroot/index.html"
+    b"webroot/home.html": b"webroot/index.html",
+    b"home": b"webroot/index.html",
+    b"home.html": b"webroot/index.html",
+    b"webroot/home": b"webroot/index.html"
 }
 STATUS_CODE = {
-    200: "HTTP/1.1 200 OK\r\n",
-    404: "HTTP/1.1 404 Not Found\r\n",
-    302: "HTTP/1.1 302 Moved Temporarily\r\n",
-    500: "HTTP/1.1 500 Internal Server Error\r\n"
+    200: b"HTTP/1.1 200 OK\r\n",
+    404: b"HTTP/1.1 404 Not Found\r\n",
+    302: b"HTTP/1.1 302 Moved Temporarily\r\n",
+    500: b"HTTP/1.1 500 Internal Server Error\r\n"
 }
+# the whole request line is checked in one pass by the C regex engine
+REQUEST_LINE_RE = re.compile(rb'GET ([^ \r\n]+) [^ \r\n]*HTTP([^ \r\n]*)\r\n')
+CONNECTION_HEADER_RE = re.compile(rb'\r\nConnection:[ \t]*([^\r\n]*)', re.IGNORECASE)
+MAX_NUMBER_DIGITS = 100  # before and after the point, so that height * width / 2 stays in the float range
+REAL_NUMBER_PATTERN = rb'-?\d{1,%d}(?:\.\d{0,%d})?' % (MAX_NUMBER_DIGITS, MAX_NUMBER_DIGITS)
+AREA_PARAMETERS_RE = re.compile(rb'\?height=(%b)&width=(%b)$' % (REAL_NUMBER_PATTERN, REAL_NUMBER_PATTERN))
+ACCEPT_RANGES = b"Accept-Ranges: bytes\r\n"
+CONTENT_TYPES = {
+    b'html': b"Content-Type: text/html\r\n\r\n",
+    b'txt': b"Content-Type: text/html\r\n\r\n",
+    b'css': b"Content-Type: text/css\r\n\r\n",
+    b'js': b"Content-Type: text/javascript\r\n\r\n",
+    b'jpg': b"Content-Type: image/jpeg\r\n" + ACCEPT_RANGES + b"\r\n",
+    b'png': b"Content-Type: image/png\r\n" + ACCEPT_RANGES + b"\r\n",
+    b'ico': b"Content-Type: image/icon\r\n" + ACCEPT_RANGES + b"\r\n",
+    b'gif': b"Content-Type: image/gif\r\n" + ACCEPT_RANGES + b"\r\n"
+}
+
+log = logging.getLogger('http')
+
+# set by a worker when a client asks to close the server
+close_server_event = threading.Event()
+# url -> (header bytes without the Date line, file data, content length), filled by load_static_cache
+STATIC_CACHE = {}
+# url -> (header bytes without the Date line, file descriptor, content length), filled by load_static_cache
+OPEN_FILES = {}
+# url -> function(client_socket) sending its response, filled by build_routes
+ROUTES = {}
+# (epoch second, formatted Date header value) of the last generated Date header
+http_date_cache = (0, b'')
 
 
 def main():
-    # Open a socket and loop forever while waiting for clients
+    load_static_cache()
+    build_routes()
+
+    if SERVER_PROCESSES == 1 or not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        return serve()
+
+    # fork server processes, each one listens on the same port with its own socket
+    # and the kernel spreads the new connections between them
+    children = []
+    for _ in range(SERVER_PROCESSES):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                exit_code = serve(MAX_CLIENTS_PER_PROCESS, reuse_port=True)
+            finally:
+                os._exit(exit_code)
+        children.append(pid)
+
+    # on kill, go through the finally below so the children are not left serving
+    signal.signal(signal.SIGTERM, raise_system_exit)
+    try:
+        # when one server process closes (e.g. a client asked to exit) close the others too
+        pid, status = os.wait()
+        children.remove(pid)
+        exit_code = os.waitstatus_to_exitcode(status)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass  # already exited, it is reaped below
+        for pid in children:
+            os.waitpid(pid, 0)
+    # a negative exit code means the child was killed by that signal
+    return exit_code if exit_code >= 0 else 128 - exit_code
+
+
+def raise_system_exit(signum, frame):
+    """ Signal handler turning a signal into SystemExit, so finally blocks still run """
+    raise SystemExit(128 + signum)
+
+
+def serve(max_clients=MAX_CLIENTS, reuse_port=False):
+    """
+    Open a socket and loop forever while waiting for clients, serving max_clients of them at the same time.
+    Returns the exit code of the server
+    """
+    log_listener = start_logging()
     try:
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # allow quick restarts while old connections are still in TIME_WAIT
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind((IP, PORT))
-        server_socket.listen()
-        print(f"Listening for connections on port {PORT}...")
-
-        while True:
-            try:
-                client_socket, client_address = server_socket.accept()
-                print('New connection received\n')
+        # connections wait in the kernel's queue while every worker is busy
+        server_socket.listen(LISTEN_BACKLOG)
+        # wake up from accept() from time to time to check if a worker asked to close the server
+        server_socket.settimeout(ACCEPT_TIMEOUT)
+        log.info('Listening for connections on port %d...', PORT)
+
+        # accept a client only when a worker is free to serve it, released by handle_client
+        free_workers = threading.BoundedSemaphore(max_clients)
+        with ThreadPoolExecutor(max_workers=max_clients) as pool:
+            while not close_server_event.is_set():
+                if not free_workers.acquire(timeout=ACCEPT_TIMEOUT):
+                    continue
+                try:
+                    client_socket, client_address = server_socket.accept()
+                except socket.timeout:
+                    free_workers.release()
+                    continue
+                log.debug('New connection received')
                 client_socket.settimeout(SOCKET_TIMEOUT)
-
-                if handle_client(client_socket) == CLOSE_SERVER_STATUS_CODE:
-                    break  # Close server for debugging purposes
-            except socket.timeout:
-                print('Connection timed out\n')
-                client_socket.close()
-                continue
-            except Exception as e:
-                print(e)
-                client_socket.close()
-                break
+                pool.submit(handle_client, client_socket, free_workers)
+    except Exception as e:
+        # log it here, while the log listener still writes the records
+        log.error(e)
+        return 1
     finally:
-        print('Closing server')
+        log.info('Closing server')
         server_socket.close()
+        log_listener.stop()
+    return 0
 
 
-def handle_client(client_socket):
-    """ Handles client requests: verifies client's requests are legal HTTP, calls function to handle the requests """
-    print('Client connected\n')
-    close_sever = False
-    while True:
-        # receive client request
-        client_request = client_socket.recv(1024).decode()
-
-        # check if request is valid HTTP request
-        valid_http, resource = validate_http_request(client_request)
-        if valid_http:
-            print('Got a valid HTTP request\n')
-            print(f'client request: {resource}\n')
-            if handle_client_request(resource, client_socket) == CLOSE_SERVER_STATUS_CODE:
-                close_sever = True
-                break
-        else:
-            print(f'Error: Not a valid HTTP request\n{client_request}\n')
-            break
-
-    print('Closing client connection\n')
-    client_socket.close()
-    if close_sever:
-        return CLOSE_SERVER_STATUS_CODE
+def start_logging():
+    """
+    Send the log records of this process to a queue, written to stdout by a background thread,
+    so the workers never wait for the terminal. Returns the listener to stop when the server closes
+    """
+    log_queue = queue.Queue()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(LOG_LEVEL)
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    log_listener.start()
+    return log_listener
 
 
-def validate_http_request(request):
+def handle_client(client_socket, free_workers):
     """
-    Check if request is a valid HTTP request and returns TRUE / FALSE and the requested URL
+    Handles client requests: verifies client's requests are legal HTTP, calls function to handle the requests.
+    Releases free_workers when the connection is closed
     """
-    # check if request is a valid HTTP GET request
-    first_line = request.split('\r\n')[0]
-    if not first_line.startswith('GET'):
-        return False, ''
+    log.debug('Client connected')
+    buffer = bytearray(REQUEST_BUFFER_SIZE)
+    received = 0
+    deadline = time.monotonic() + KEEP_ALIVE_MAX_TIME
+    try:
+        keep_open = True
+        # past the deadline, close only when no part of a next request was received, so it is not lost
+        while keep_open and (received > 0 or time.monotonic() < deadline):
+            # receive client request
+            request_end, received = receive_request(client_socket, buffer, received)
+            if request_end == -1:
+                break  # the client closed the connection or sent a too long request
+
+            # answer all the requests received so far and flush their responses together
+            with corked(client_socket):
+                keep_open, received = handle_received_requests(client_socket, buffer, request_end, received)
+    except socket.timeout:
+        log.debug('Connection timed out')
+    except ConnectionError as e:
+        log.debug('Connection lost: %s', e)  # the client reset or closed the connection
+    except Exception:
+        log.exception('Error while handling client')
+    finally:
+        log.debug('Closing client connection')
+        client_socket.close()
+        free_workers.release()
 
-    split_request = first_line.split()
-    if len(split_request) != 3:
-        return False, ''
-    if 'HTTP' not in split_request[2]:
-        return False, ''
 
-    url = split_request[1]
-    return True, url
+def handle_received_requests(client_socket, buffer, request_end, received):
+    """
+    Handle every whole request in the buffer, the first one ends at request_end.
+    Returns whether to keep the connection open and the number of bytes left in the buffer
+    """
+    while request_end != -1:
+        # check if request is valid HTTP request
+        valid_http, resource, keep_alive = validate_http_request(buffer, request_end)
+        if not valid_http:
+            log.debug('Error: Not a valid HTTP request\n%s', bytes(buffer[:request_end]))
+            return False, received
+
+        log.debug('Got a valid HTTP request')
+        log.debug('client request: %s', resource)
+        if handle_client_request(resource, client_socket) == CLOSE_SERVER_STATUS_CODE:
+            close_server_event.set()  # Close server for debugging purposes
+            return False, received
+        if not keep_alive:
+            return False, received  # no need to wait for another request
+
+        # keep the part of the next request that was already received
+        buffer[:received - request_end] = buffer[request_end:received]
+        received -= request_end
+        request_end = buffer.find(b'\r\n\r\n', 0, received)
+        if request_end != -1:
+            request_end += 4
+    return True, received
+
+
+def receive_request(client_socket, buffer, received):
+    """
+    Receive from client into buffer until it holds the whole header of a request.
+    Returns the index right after the request header (-1 if the client closed the connection
+    or the request is bigger than MAX_REQUEST_SIZE) and the number of bytes in the buffer
+    """
+    request_end = buffer.find(b'\r\n\r\n', 0, received)
+    while request_end == -1:
+        if received == len(buffer):
+            if len(buffer) >= MAX_REQUEST_SIZE:
+                return -1, received
+            buffer.extend(bytes(len(buffer)))  # make room for a long request
+
+        n = client_socket.recv_into(memoryview(buffer)[received:])
+        if n == 0:
+            return -1, received
+        # the end of the header may start in the previously received bytes
+        request_end = buffer.find(b'\r\n\r\n', max(received - 3, 0), received + n)
+        received += n
+    return request_end + 4, received
+
+
+def validate_http_request(request, request_end):
+    """
+    Check if request is a valid HTTP request and returns TRUE / FALSE, the requested URL
+    and whether the client wants to keep the connection open after the response
+    """
+    # check if the request line is: GET <url> HTTP/<version>
+    request_line = REQUEST_LINE_RE.match(request, 0, request_end)
+    if request_line is None:
+        return False, b'', False
+
+    url = request_line.group(1)
+    # HTTP/1.1 keeps the connection open by default, HTTP/1.0 closes it
+    keep_alive = request_line.group(2) != b'/1.0'
+    connection = CONNECTION_HEADER_RE.search(request, request_line.end() - 2, request_end)
+    if connection is not None:
+        connection = connection.group(1).lower()
+        if b'close' in connection:
+            keep_alive = False
+        elif b'keep-alive' in connection:
+            keep_alive = True
+    return True, url, keep_alive
 
 
 def handle_client_request(resource, client_socket):
@@ -112,21 +306,33 @@ def handle_client_request(resource, client_socket):
     #  add code that given a resource (URL and parameters) generates the proper response
     #  and sends it to the client
 
-    url = DEFAULT_URL if resource == '' or resource == '/' else resource.strip('/')
+    url = get_canonical_url(resource)
 
-    if url.endswith("exit"):  # Close server for debugging purposes
-        return CLOSE_SERVER_STATUS_CODE
+    # handle static files and redirections, known since startup:
+    handler = ROUTES.get(url)
+    if handler is not None:
+        return handler(client_socket)
+
+    return handle_dynamic_request(url, client_socket)
+
+
+def get_canonical_url(resource):
+    """ Get the path inside the webroot of the requested resource """
+    url = DEFAULT_URL if resource == b'' or resource == b'/' else resource.strip(b'/')
 
-    if not url.startswith('webroot/'):
-        url = 'webroot/' + url
+    if not url.startswith(b'webroot/'):
+        url = b'webroot/' + url
+    return url
 
-    # handle Moved temporarily:
-    if url in REDIRECTION_DICTIONARY:
-        return moved_temporarily(client_socket, url)
 
-    server_function = url.split("/")[-1]
+def handle_dynamic_request(url, client_socket):
+    """ Generate proper HTTP response for a url that is not in ROUTES and send to client """
+    _, _, server_function = url.rpartition(b'/')
+    if server_function.endswith(b"exit"):  # Close server for debugging purposes
+        return CLOSE_SERVER_STATUS_CODE
+
     # handle area calculation
-    if 'calculate-area' in server_function:
+    if server_function.startswith(b'calculate-area'):
         return calculate_area(client_socket, server_function)
 
     #  if the resource is not found, send a 404 response
@@ -134,73 +340,115 @@ def handle_client_request(resource, client_socket):
         return not_found(client_socket)
 
     # handle OK:
-    return ok(client_socket, url=url)
+    return ok_sendfile(client_socket, url)
 
 
 def not_found(client_socket):
     """ Send 404 Not Found to client """
-    massage = "404 Not Found\r\n"
+    massage = b"404 Not Found\r\n"
     http_response = STATUS_CODE[404] + get_http_header(content_length=len(massage)) + massage
-    client_socket.sendall(http_response.encode())
+    client_socket.sendall(http_response)
     return 404
 
 
-def ok(client_socket, data=b'', url=''):
-    """ Send 200 OK to client """
-    if url != '' and data == b'':
-        data = get_file_data(url)
-    http_header = get_http_header(content_length=len(data), url=url)
+def ok(client_socket, data):
+    """ Send 200 OK with in-memory data (dynamic content) to client """
+    http_header = get_http_header(content_length=len(data))
+    http_response = STATUS_CODE[200] + http_header
+    client_socket.sendall(http_response + data)
+    return 200
+
+
+def ok_cached(client_socket, entry):
+    """ Send 200 OK with a response prepared by load_static_cache to client """
+    send_cached(client_socket, STATUS_CODE[200], entry)
+    return 200
+
+
+def ok_open_file(client_socket, entry):
+    """ Send 200 OK with a file opened by load_static_cache to client """
+    header_prefix, fd, content_length = entry
+    date_line = b'Date: ' + get_http_date() + b'\r\n'
+    client_socket.sendall(STATUS_CODE[200] + date_line + header_prefix)
+    send_shared_file(client_socket, fd, content_length)
+    return 200
+
+
+def ok_sendfile(client_socket, url):
+    """ Send 200 OK to client, letting the kernel copy the file straight to the socket """
+    content_length = os.path.getsize(url)
+    http_header = get_http_header(content_length=content_length, url=url)
     http_response = STATUS_CODE[200] + http_header
-    client_socket.sendall(http_response.encode() + data)
+    client_socket.sendall(http_response)
+    send_file(client_socket, url, content_length)
     return 200
 
 
-def moved_temporarily(client_socket, url):
+def moved_temporarily(client_socket, target):
     """ Send 302 Moved Temporarily to client """
 
     #  if the resource is not found, send a 404 response
-    if not os.path.isfile(REDIRECTION_DICTIONARY[url]):
+    if not os.path.isfile(target):
         return not_found(client_socket)
 
-    data = get_file_data(REDIRECTION_DICTIONARY[url])
-    location = f"Location: http://{REDIRECTION_DICTIONARY[url]}\r\n"
-    http_header = get_http_header(content_length=len(data), url=REDIRECTION_DICTIONARY[url])
+    content_length = os.path.getsize(target)
+    location = b"Location: http://%b\r\n" % target
+    http_header = get_http_header(content_length=content_length, url=target)
     http_response = STATUS_CODE[302] + location + http_header
-    client_socket.sendall(http_response.encode() + data)
+    client_socket.sendall(http_response)
+    send_file(client_socket, target, content_length)
     return 302
 
 
+def moved_temporarily_cached(client_socket, response_start, entry):
+    """ Send 302 Moved Temporarily, with status and Location lines prepared by build_routes, to client """
+    send_cached(client_socket, response_start, entry)
+    return 302
+
+
+def send_cached(client_socket, response_start, entry):
+    """ Send the response start (status line...), the Date line and a response prepared by load_static_cache """
+    header_prefix, data, content_length = entry
+    http_header = response_start + b'Date: ' + get_http_date() + b'\r\n' + header_prefix
+    if content_length < LARGE_BODY_SIZE:
+        client_socket.sendall(http_header + data)
+    else:
+        send_header_and_body(client_socket, http_header, data)
+
+
 def internal_server_error(client_socket, message):
     """ Send 500 Internal Server Error to client """
     http_response = STATUS_CODE[500] + get_http_header(content_length=len(message)) + message
-    client_socket.sendall(http_response.encode())
+    client_socket.sendall(http_response)
     return 500
 
 
 def calculate_area(client_socket, request):
     """ Calculate area and send to client """
-    parameters = request.split('?')[-1].split('&')
-    if not len(parameters) == 2:
-        return internal_server_error(client_socket, f'Many or less parameters, expected 2, got {len(parameters)}')
-
-    height_str = parameters[0].split('=')[-1]
-    width_str = parameters[1].split('=')[-1]
+    parameters = AREA_PARAMETERS_RE.search(request)
+    if parameters is None:
+        return internal_server_error(client_socket, b'Expected parameters height and width with real number values')
 
-    height = get_real_number(height_str)
-    width = get_real_number(width_str)
-    if height is None or width is None:
-        return internal_server_error(client_socket, 'Not real number value for height or width')
+    height = get_real_number(parameters.group(1))
+    width = get_real_number(parameters.group(2))
 
-    area = str((height * width) / 2)
+    area = str(get_area(height, width))
     # check if area is float of int
     if area.endswith('.0'):
         area = area[:-2]
     return ok(client_socket, data=area.encode())
 
 
+def get_area(height, width):
+    """ Calculate the area (height * width / 2), kept exact when it is a whole number """
+    area = height * width
+    if isinstance(area, int) and area % 2 == 0:
+        return area // 2
+    return area / 2
+
+
 def get_real_number(num_str):
-    if not re.match(r'^-?\d+\.?\d*$', num_str):
-        return None
+    """ Convert a number already matched by REAL_NUMBER_PATTERN to int or float """
     try:
         result = int(num_str)
     except ValueError:
@@ -208,39 +456,140 @@ def get_real_number(num_str):
     return result
 
 
-def get_file_data(filename):
-    """ Get data from file """
-    with open(filename, 'rb') as f:
-        file_data = f.read()
-        return file_data
+def send_header_and_body(client_socket, http_header, data):
+    """ Send header and body to client without copying the body into one response bytes """
+    if not hasattr(client_socket, 'sendmsg'):
+        client_socket.sendall(http_header)
+        client_socket.sendall(data)
+        return
+
+    # one gather write for both, then send whatever the socket did not take yet
+    sent = client_socket.sendmsg([http_header, data])
+    if sent < len(http_header):
+        client_socket.sendall(memoryview(http_header)[sent:])
+        sent = len(http_header)
+    if sent < len(http_header) + len(data):
+        client_socket.sendall(memoryview(data)[sent - len(http_header):])
+
+
+def send_file(client_socket, filename, content_length):
+    """ Send file data to client without reading the whole file into memory """
+    with open(filename, 'rb', buffering=0) as f:
+        if hasattr(os, 'sendfile'):
+            # socket.sendfile loops over os.sendfile and also copes with the socket timeout
+            client_socket.sendfile(f, 0, content_length)
+            return
+        # no zero-copy way left: os.splice only exists on Linux, which always has os.sendfile
+        while chunk := f.read(FILE_CHUNK_SIZE):
+            client_socket.sendall(chunk)
+
+
+def send_shared_file(client_socket, fd, content_length):
+    """
+    Send a file opened by load_static_cache to client. Every read of fd is given its offset
+    (os.sendfile, or os.pread if the file cannot be sent with sendfile), so workers can share it
+    """
+    # poll() rather than select(), which fails for descriptor numbers above FD_SETSIZE (1024)
+    poller = select.poll()
+    poller.register(client_socket, select.POLLOUT)
+    timeout = client_socket.gettimeout()
+    offset = 0
+    while offset < content_length:
+        try:
+            sent = os.sendfile(client_socket.fileno(), fd, offset, content_length - offset)
+        except BlockingIOError:
+            # the socket has a timeout, so it is non-blocking: wait until it can take more data
+            if not poller.poll(None if timeout is None else timeout * 1000):
+                raise socket.timeout('timed out')
+            continue
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+            # sendfile does not support this file, read it at the offset instead
+            while offset < content_length:
+                chunk = os.pread(fd, min(FILE_CHUNK_SIZE, content_length - offset), offset)
+                if not chunk:
+                    raise OSError(f'file is shorter than {content_length} bytes since startup')
+                client_socket.sendall(chunk)
+                offset += len(chunk)
+            return
+        if sent == 0:
+            raise OSError(f'file is shorter than {content_length} bytes since startup')
+        offset += sent
+
+
+@contextlib.contextmanager
+def corked(client_socket):
+    """
+    Hold back partial TCP segments while sending responses (header and body sent separately,
+    or several pipelined responses), so they leave together in full segments when uncorked
+    """
+    if TCP_CORK is None:
+        yield
+        return
+    client_socket.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 1)
+    try:
+        yield
+    finally:
+        client_socket.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 0)
 
 
-def get_http_header(content_length, url=''):
+def get_http_header(content_length, url=b''):
     """ Generate HTTP header """
-    date = datetime.datetime.now().strftime("%a, %d %b %Y %H:%M:%S GMT")
-    http_header = f"Date: {date}\r\n" + \
-                  f"Content-Length: {content_length}\r\n"
-    accept_bytes = "Accept-Ranges: bytes\r\n\r\n"
-
-    file_type = 'html' if url == '' else url.split('.')[-1]
-    if file_type == 'html' or file_type == 'txt':
-        http_header += "Content-Type: text/html\r\n\r\n"
-    elif file_type == 'css':
-        http_header += "Content-Type: text/css\r\n\r\n"
-    elif file_type == 'js':
-        http_header += "Content-Type: text/javascript\r\n\r\n"
-    elif file_type == 'jpg':
-        http_header += "Content-Type: image/jpeg\r\n" + accept_bytes
-    elif file_type == 'png':
-        http_header += "Content-Type: image/png\r\n" + accept_bytes
-    elif file_type == 'ico':
-        http_header += "Content-Type: image/icon\r\n" + accept_bytes
-    elif file_type == 'gif':
-        http_header += "Content-Type: image/gif\r\n" + accept_bytes
-
-    return http_header
+    http_header = b'Date: %b\r\nContent-Length: %d\r\n' % (get_http_date(), content_length)
+    return http_header + get_content_type_header(url)
+
+
+def get_content_type_header(url=b''):
+    """ Get the Content-Type part of the HTTP header according to the file type """
+    return CONTENT_TYPES.get(url.rpartition(b'.')[2], CONTENT_TYPES[b'html'])
+
+
+def get_http_date():
+    """ Get the Date header value, formatted at most once per second """
+    global http_date_cache
+    now = int(time.time())
+    if now != http_date_cache[0]:
+        # formatdate does not depend on the locale and really gives the time in GMT
+        http_date_cache = (now, email.utils.formatdate(now, usegmt=True).encode())
+    return http_date_cache[1]
+
+
+def build_routes():
+    """ Map every url whose response is known since startup to the function that sends it """
+    for url, entry in STATIC_CACHE.items():
+        ROUTES[url] = partial(ok_cached, entry=entry)
+    for url, entry in OPEN_FILES.items():
+        ROUTES[url] = partial(ok_open_file, entry=entry)
+    for url, target in REDIRECTION_DICTIONARY.items():
+        # keys may be given with or without 'webroot/', requests are looked up by their canonical url
+        url = get_canonical_url(url)
+        entry = STATIC_CACHE.get(target)
+        if entry is None:
+            ROUTES[url] = partial(moved_temporarily, target=target)
+        else:
+            response_start = STATUS_CODE[302] + b"Location: http://%b\r\n" % target
+            ROUTES[url] = partial(moved_temporarily_cached, response_start=response_start, entry=entry)
+
+
+def load_static_cache():
+    """
+    Read the webroot files once (or keep the big ones open) and prepare everything but the Date line of their responses
+    """
+    for root, _, files in os.walk(WEBROOT):
+        for name in files:
+            url = os.fsencode(os.path.join(root, name).replace(os.sep, '/'))
+            content_length = os.path.getsize(url)
+            header_prefix = b'Content-Length: %d\r\n' % content_length + get_content_type_header(url)
+            if content_length <= STATIC_CACHE_MAX_FILE_SIZE:
+                with open(url, 'rb') as f:
+                    STATIC_CACHE[url] = (header_prefix, f.read(), content_length)
+            elif hasattr(os, 'sendfile') and len(OPEN_FILES) < REGISTERED_MAX:
+                # big files are sent with sendfile instead of being kept in memory.
+                # send_shared_file never moves the file position, so all the workers can share one descriptor
+                OPEN_FILES[url] = (header_prefix, os.open(url, os.O_RDONLY), content_length)
 
 
 if __name__ == "__main__":
     # Call the main handler function
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file